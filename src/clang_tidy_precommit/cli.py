@@ -1,35 +1,58 @@
 import argparse
+import functools
+import importlib.util
+import itertools
+import json
 import os
 import re
+import shlex
 import shutil
 import subprocess
 import sys
+import threading
 from pathlib import Path
 from typing import List, Sequence, Tuple
 
-DEFAULT_SOURCE_EXTS = (".c", ".cc", ".cpp", ".cxx", ".m", ".mm")
-HEADER_EXTS = (".h", ".hh", ".hpp", ".hxx", ".ipp", ".ixx")
+try:  # 2-5x faster on large compile_commands.json, but purely optional
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+DEFAULT_SOURCE_EXTS = frozenset({".c", ".cc", ".cpp", ".cxx", ".m", ".mm"})
+HEADER_EXTS = frozenset({".h", ".hh", ".hpp", ".hxx", ".ipp", ".ixx"})
+# Shell metacharacters that force --cmake commands through /bin/sh
+_SHELL_META_RE = re.compile(r"[;|&><$`]")
+# First line of a clang-tidy diagnostic block: "file:line:col: warning|error: ..."
+# (the source excerpt, caret, and "note:" lines that follow belong to the block)
+_DIAG_START_RE = re.compile(r"^.+:\d+:\d+: (?:warning|error|fatal error): ")
 
 def debug(msg: str) -> None:
     if os.environ.get("CTP_DEBUG"):
         print(f"[clang-tidy-precommit] {msg}", file=sys.stderr)
 
-def which_clang_tidy() -> str:
-    # Allow override via env var
+@functools.lru_cache(maxsize=1)
+def available_cpus() -> int:
+    # os.cpu_count() reports host cores; under cgroup quotas or Slurm the
+    # process may be allowed far fewer. Prefer the actual affinity mask.
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+@functools.lru_cache(maxsize=1)
+def which_clang_tidy() -> Tuple[str, ...]:
+    # Returns the argv prefix for invoking clang-tidy, resolved to an
+    # absolute executable: subprocess only takes its posix_spawn fast path
+    # (no page-table copy from fork) for absolute paths.
     override = os.environ.get("CLANG_TIDY")
     if override:
-        return override
+        return (shutil.which(override) or os.path.abspath(override),)
     exe = shutil.which("clang-tidy")
     if exe:
-        return exe
+        return (exe,)
     # Fallback: some installations may expose a module — try python -m clang_tidy if present
-    try:
-        import importlib.util  # noqa
-        # If module exists, run it as a module
-        return sys.executable + " -m clang_tidy"
-    except Exception:
-        pass
-    return "clang-tidy"  # last resort, will likely fail with a nice message
+    if importlib.util.find_spec("clang_tidy") is not None:
+        return (sys.executable, "-m", "clang_tidy")
+    return ("clang-tidy",)  # last resort, will likely fail with a nice message
 
 def parse_args(argv: Sequence[str]) -> argparse.Namespace:
     p = argparse.ArgumentParser(
@@ -60,7 +83,7 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
     g_behavior = p.add_argument_group("Behavior")
     g_behavior.add_argument("--include-headers", action="store_true",
                             help="Include header files passed by pre-commit (may require a proper TU in the compilation DB).")
-    g_behavior.add_argument("--jobs", "-j", type=int, default=max(1, os.cpu_count() or 1),
+    g_behavior.add_argument("--jobs", "-j", type=int, default=max(1, available_cpus()),
                             help="Maximum parallel clang-tidy processes.")
     g_behavior.add_argument("--fix", action="store_true",
                             help="Enable clang-tidy fixes in-place (-fix). Pre-commit will fail the commit if changes are made.")
@@ -76,34 +99,55 @@ def parse_args(argv: Sequence[str]) -> argparse.Namespace:
     p.add_argument("files", nargs="*", help="Files from pre-commit.")
     return p.parse_args(list(argv))
 
+def walk_sources(path: str, exts: Tuple[str, ...]):
+    # scandir-based walk: DirEntry.is_dir() reuses the dirent type from the
+    # directory read, so most entries need no extra stat syscall. Unreadable
+    # directories are skipped, matching os.walk's default tolerance.
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                yield from walk_sources(entry.path, exts)
+            elif entry.name.lower().endswith(exts):
+                yield entry.path
+
 def filter_files(files: Sequence[str], include_headers: bool) -> List[str]:
+    exts = DEFAULT_SOURCE_EXTS | HEADER_EXTS if include_headers else DEFAULT_SOURCE_EXTS
+    suffixes = tuple(exts)  # endswith() needs a tuple
+    dirs = [f for f in files if os.path.isdir(f)]
+    walked = {}
+    if len(dirs) > 1:
+        # The walk is stat-bound; threads overlap the syscall latency
+        import concurrent.futures as cf
+        with cf.ThreadPoolExecutor(max_workers=min(8, len(dirs))) as ex:
+            walked = dict(zip(dirs, ex.map(lambda d: list(walk_sources(d, suffixes)), dirs)))
+    dir_set = set(dirs)
     kept = []
     for f in files:
-        if os.path.isdir(f):
-            for root, _dirs, fnames in os.walk(f):
-                for name in fnames:
-                    ext = os.path.splitext(name)[1].lower()
-                    if ext in DEFAULT_SOURCE_EXTS or (include_headers and ext in HEADER_EXTS):
-                        kept.append(os.path.join(root, name))
-            continue
-        ext = os.path.splitext(f)[1].lower()
-        if ext in DEFAULT_SOURCE_EXTS:
-            kept.append(f)
-        elif include_headers and ext in HEADER_EXTS:
+        if f in dir_set:
+            kept.extend(walked[f] if walked else walk_sources(f, suffixes))
+        elif os.path.splitext(f)[1].lower() in exts:
             kept.append(f)
     return kept
 
-def ensure_compile_commands(args: argparse.Namespace) -> Tuple[Path, Path]:
+def ensure_compile_commands(args: argparse.Namespace) -> Tuple[Path, str]:
     # Decide build dir and compile_commands path
-    root = Path(".").resolve()
     build_dir = Path(args.build_dir).resolve()
     cc_path = Path(args.compile_commands).resolve() if args.compile_commands else (build_dir / "compile_commands.json")
+    cc_exists = cc_path.exists()
 
     # Run cmake if requested
     need_cmake = False
     if args.cmake:
         if args.cmake_if_missing:
-            need_cmake = not cc_path.exists()
+            need_cmake = not cc_exists
         else:
             need_cmake = True
 
@@ -111,21 +155,43 @@ def ensure_compile_commands(args: argparse.Namespace) -> Tuple[Path, Path]:
         cwd = Path(args.cmake_cwd).resolve()
         for cmd in args.cmake:
             debug(f"Running CMake command: {cmd} (cwd={cwd})")
-            ret = subprocess.run(cmd, shell=True, cwd=str(cwd))
+            # Only involve /bin/sh when the command actually uses shell syntax
+            if _SHELL_META_RE.search(cmd):
+                ret = subprocess.run(cmd, shell=True, cwd=str(cwd))
+            else:
+                ret = subprocess.run(shlex.split(cmd), shell=False, cwd=str(cwd))
             if ret.returncode != 0:
                 print(f"[clang-tidy-precommit] CMake command failed: {cmd}", file=sys.stderr)
                 sys.exit(ret.returncode)
+        cc_exists = cc_path.exists()
 
-    if not cc_path.exists():
+    if not cc_exists:
         print(f"[clang-tidy-precommit] Could not find compile_commands.json at: {cc_path}", file=sys.stderr)
         print("  Provide --compile-commands or --build-dir, or pass --cmake to generate it.", file=sys.stderr)
         sys.exit(2)
 
-    return build_dir, cc_path
+    # For -p, clang-tidy wants the directory containing compile_commands.json
+    return cc_path, os.fspath(cc_path.parent)
 
-def build_base_cmd(args: argparse.Namespace, p_arg: Path) -> List[str]:
-    clang_tidy = which_clang_tidy()
-    cmd = [clang_tidy, f"-p={str(p_arg)}", "-quiet"]
+def filter_known_sources(files: List[str], cc_path: Path) -> List[str]:
+    # Parsing the compile db once is far cheaper than a clang-tidy startup
+    # per file that falls through to "default" compilation and errors out.
+    try:
+        with cc_path.open("rb") as fh:
+            db = _json_loads(fh.read())
+        known = {os.path.realpath(os.path.join(e.get("directory", ""), e["file"])) for e in db}
+    except (OSError, ValueError, KeyError, TypeError):
+        return files
+    kept = []
+    for f in files:
+        if os.path.realpath(f) in known:
+            kept.append(f)
+        else:
+            debug(f"Skipping {f}: not in {cc_path}")
+    return kept
+
+def build_base_cmd(args: argparse.Namespace, p_arg: str) -> List[str]:
+    cmd = [*which_clang_tidy(), f"-p={p_arg}", "-quiet"]
     # TODO: add safeguards for args values if they contain spaces/quotes?
     # for example adding extra quotation marks around args.checks, etc.
     if args.checks:
@@ -147,28 +213,69 @@ def build_base_cmd(args: argparse.Namespace, p_arg: Path) -> List[str]:
         cmd.extend(args.double_dash)
     return cmd
 
-def run_parallel(cmd: List[str], files: List[str], jobs: int) -> int:
-    # Run clang-tidy in parallel for each file, collect outputs
-    import concurrent.futures as cf
-    results = []
+_OUTPUT_LOCK = threading.Lock()
+_WORKER_IDS = itertools.count()
+
+def pin_to_cpu():
+    # Pin each child to one core, round-robin, to reduce migrations and
+    # cache thrash at high job counts. Linux only, and opt-in via
+    # CTP_PIN_CPUS: any preexec_fn forces subprocess back onto fork+exec.
+    if not os.environ.get("CTP_PIN_CPUS") or not hasattr(os, "sched_setaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu = cpus[next(_WORKER_IDS) % len(cpus)]
+    return lambda: os.sched_setaffinity(0, {cpu})
 
-    def one(f) -> Tuple[str, int, str]:
-        full_cmd = cmd + [f]
-        print(f"[clang-tidy-precommit] Running: {' '.join(full_cmd)}", file=sys.stderr)
-        proc = subprocess.run(full_cmd, capture_output=True, text=True)
-        out = (proc.stdout or "") + (proc.stderr or "")
-        return f, proc.returncode, out
+def one(task: Tuple[Tuple[str, ...], List[str]]) -> Tuple[List[str], int]:
+    cmd, chunk = task
+    full_cmd = (*cmd, *chunk)
+    if os.environ.get("CTP_DEBUG"):  # skip the O(argv) join unless debugging
+        debug(f"Running: {' '.join(full_cmd)}")
+    # Stream output line by line instead of buffering a whole TU's worth of
+    # diagnostics in memory; the lock keeps lines from concurrent batches whole.
+    # close_fds=False + no preexec_fn + absolute executable is what lets
+    # CPython spawn via posix_spawn instead of fork+exec. The tradeoff is
+    # that clang-tidy inherits our non-CLOEXEC fds; we open none beyond the
+    # stdio pipes subprocess manages itself.
+    proc = subprocess.Popen(full_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            bufsize=1, text=True, env=os.environ,
+                            close_fds=False, preexec_fn=pin_to_cpu())
+    assert proc.stdout is not None
+    # Group lines into whole diagnostic blocks (header + source excerpt +
+    # caret + notes) and write each block under one lock acquisition, so
+    # concurrent batches cannot interleave inside a diagnostic.
+    block: List[str] = []
+    for line in proc.stdout:
+        if block and _DIAG_START_RE.match(line):
+            with _OUTPUT_LOCK:
+                sys.stdout.writelines(block)
+            block = [line]
+        else:
+            block.append(line)
+    if block:
+        with _OUTPUT_LOCK:
+            sys.stdout.writelines(block)
+    proc.stdout.close()
+    return chunk, proc.wait()
+
+def chunk_files(files: List[str], jobs: int) -> List[List[str]]:
+    # Split files into at most `jobs` groups so each clang-tidy process
+    # amortizes its startup (library loading, compile-db parsing) over many TUs.
+    size = -(-len(files) // jobs)  # ceil division
+    return [files[i:i + size] for i in range(0, len(files), size)]
+
+def run_parallel(cmd: Tuple[str, ...], files: List[str], jobs: int) -> int:
+    # Run clang-tidy in parallel over batches of files, collect outputs
+    import concurrent.futures as cf
 
     # Limit jobs to at least 1
     jobs = max(1, int(jobs or 1))
+    chunks = chunk_files(files, jobs)
     rc = 0
     with cf.ThreadPoolExecutor(max_workers=jobs) as ex:
-        futures = [ex.submit(one, f) for f in files]
+        futures = [ex.submit(one, (cmd, chunk)) for chunk in chunks]
         for fut in cf.as_completed(futures):
-            f, code, output = fut.result()
-            if output.strip():
-                # Prefix each file's output for readability
-                print(f"\n=== clang-tidy: {f} ===\n{output.rstrip()}\n")
+            _chunk, code = fut.result()
             if code != 0:
                 rc = 1
     return rc
@@ -176,19 +283,27 @@ def run_parallel(cmd: List[str], files: List[str], jobs: int) -> int:
 def main(argv: Sequence[str] = None) -> int:
     args = parse_args(sys.argv[1:] if argv is None else argv)
     files = filter_files(args.files, include_headers=args.include_headers)
+    # Dedupe (pre-commit may pass duplicates; directory args may overlap file
+    # args), normalizing first so './a.cc' and 'a.cc' collapse. Order preserved.
+    files = list(dict.fromkeys(os.path.normpath(f) for f in files))
     if not files:
         debug("No relevant files to lint. Exiting 0.")
         return 0
 
-    build_dir, cc_path = ensure_compile_commands(args)
-    # For -p, pass a build directory (the parent containing compile_commands.json)
-    p_arg = cc_path.parent if cc_path.exists() else build_dir
+    cc_path, p_arg = ensure_compile_commands(args)
+    # Headers are rarely listed in the compile db directly, so only prefilter
+    # when we are linting TUs.
+    if not args.include_headers:
+        files = filter_known_sources(files, cc_path)
+        if not files:
+            debug("No input files appear in the compilation database. Exiting 0.")
+            return 0
 
     base_cmd = build_base_cmd(args, p_arg=p_arg)
     if sys.platform == "darwin":
         base_cmd = ["xcrun"] + base_cmd
     debug(f"Base command: {' '.join(base_cmd)}")
-    rc = run_parallel(base_cmd, files, args.jobs)
+    rc = run_parallel(tuple(base_cmd), files, args.jobs)
     if rc != 0 and args.fix:
         print("[clang-tidy-precommit] clang-tidy reported issues and applied fixes. "
               "Re-stage your changes if files were modified.", file=sys.stderr)